@@ -0,0 +1,10 @@
+# cython: language_level=3
+#
+# Compiled inner loop for the gmail tag diff.  The set arithmetic in
+# sync_gmail_tags_batch is pure Python dict/set churn; typing the
+# arguments lets Cython skip the generic dispatch and frame setup.
+
+
+cpdef tuple sync_tags_inner(set tags, set keywords):
+    """Return (to_add, to_remove) for a tag/keyword row diff."""
+    return (frozenset(keywords - tags), frozenset(tags - keywords))
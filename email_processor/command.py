@@ -1,13 +1,21 @@
 import notmuch
 from notmuch import Database, Query
-from util import MessageProxy, logger, Pipeline
+from util import (MessageProxy, KeywordCache, logger, AsyncPipeline,
+                  fuse_stages, prefetch)
 import sys
 import logging
+import multiprocessing
 import os
-import subprocess
-import functools
+import shutil
 import click
 
+try:
+    from _sync import sync_tags_inner
+except ImportError:
+    # extension not built; same semantics, just interpreted
+    def sync_tags_inner(tags, keywords):
+        return frozenset(keywords - tags), frozenset(tags - keywords)
+
 
 DATABASE_PATH = "/home/kotfic/mail"
 GMAIL_HEADERS_TO_TAGS = {
@@ -19,104 +27,128 @@ GMAIL_HEADERS_TO_TAGS = {
 
 GMAIL_TAGS_TO_HEADERS = {v: k for k, v in GMAIL_HEADERS_TO_TAGS.items()}
 
-maildir_tags = set([
+# fused lookup table; one dict hit replaces the two try/except probes.
+# The tag vocabulary is small and fixed, so intern everything once and
+# let later comparisons ride on pointer equality.
+_TOGGLE = {}
+_TOGGLE.update(GMAIL_HEADERS_TO_TAGS)
+_TOGGLE.update(GMAIL_TAGS_TO_HEADERS)
+_TOGGLE = {sys.intern(k): sys.intern(v) for k, v in _TOGGLE.items()}
+
+maildir_tags = frozenset(sys.intern(t) for t in (
     'unread',
     'draft',
     'flagged',
     'passed',
     'signed',
-    'replied'])
+    'replied'))
 
-exclude_sync_tags = set([
-    'new'
-]) | maildir_tags
+exclude_sync_tags = frozenset(
+    (sys.intern('new'),)) | maildir_tags
 
 
 def db():
     return Database(DATABASE_PATH, create=False, mode=Database.MODE.READ_WRITE)
 
 
+_keyword_cache = None
+
+
+def keyword_cache():
+    # created lazily so pool workers open their own connection after
+    # the fork rather than sharing the parent's
+    global _keyword_cache
+    if _keyword_cache is None:
+        _keyword_cache = KeywordCache()
+    return _keyword_cache
+
+
 def count_messages(query_string):
     return Query(db(), query_string).count_messages()
 
 
-def get_messages(query_string):
-    for msg in Query(db(), query_string).search_messages():
-        yield MessageProxy(msg)
+def get_messages(dbh, query_string):
+    """Materialize the whole result set with one bulk scan.
+
+    Advancing the notmuch iterator lazily costs a Xapian lookup per
+    message (the classic N+1 pattern); a single pass up front collects
+    everything and the pipeline then works purely in memory.
+    """
+    return [MessageProxy(msg)
+            for msg in Query(dbh, query_string).search_messages()]
 
 
 def toggle_header(item):
-    try:
-        return GMAIL_HEADERS_TO_TAGS[item]
-    except KeyError:
-        pass
-    try:
-        return GMAIL_TAGS_TO_HEADERS[item]
-    except KeyError:
-        pass
+    return _TOGGLE.get(item, item)
 
-    return item
 
+def sync_gmail_tags(message):
+    return sync_gmail_tags_batch([message])[0]
 
-def coroutine(func):
-    def _coroutine(*args, **kwargs):
-        cr = func(*args, **kwargs)
-        cr.next()
-        return cr
+def sync_gmail_tags_batch(batch):
+    """Columnar variant of sync_gmail_tags for a whole batch.
 
-    return _coroutine
+    Rather than two small set differences per message, lay the batch
+    out as (idx, tag) and (idx, keyword) rows and take the difference
+    once over everything -- the same work as N per-message diffs but
+    in two bulk set operations.
+    """
+    cache = keyword_cache()
 
-def stage(func):
-    def _stage(target, *args, **kwargs):
-        try:
-            while True:
-                message = (yield)
-                message = func(message, *args, **kwargs)
-                target.send(message)
-        except GeneratorExit:
-            pass
-    return coroutine(_stage)
-
-def sink(func):
-    def _sink(*args, **kwargs):
-        try:
-            while True:
-                message = (yield)
-                func(message, *args, **kwargs)
-        except GeneratorExit:
-            pass
+    tag_rows = set()
+    kw_rows = set()
 
-    # Syncs should always be primed
-    return coroutine(_sink)()
+    for i, message in enumerate(batch):
+        path = message.get_filename()
+        mtime_ns = os.stat(path).st_mtime_ns
 
+        tags = {t for t in message.get_tags()
+                if t not in exclude_sync_tags}
 
-@stage
-def sync_gmail_tags(message):
+        cached = cache.get(path, mtime_ns)
+        if cached is not None:
+            # file untouched since the last sync; if the tags still
+            # match there is nothing to read and nothing to diff
+            if cached == tags:
+                continue
 
-    tags = set(str(t) for t in message.get_tags()
-               if t not in exclude_sync_tags)
-    try:
-        keywords = set(toggle_header(t) for t in message.get_keywords())
-    except AttributeError:
-        return message
+            keywords = cached
+        else:
+            keywords = message.get_keywords()
+            if keywords is None:
+                continue
 
-    for tag in (tags - keywords):
-        message.remove_tag(tag)
+            keywords = set(toggle_header(t) for t in keywords)
 
-    for tag in (keywords - tags):
-        message.add_tag(tag)
+            if not MessageProxy.dryrun:
+                cache.put(path, mtime_ns, keywords)
+
+        kw_rows.update((i, t) for t in keywords)
+        tag_rows.update((i, t) for t in tags)
+
+    cache.commit()
+
+    to_add, to_remove = sync_tags_inner(tag_rows, kw_rows)
+
+    for i, tag in to_remove:
+        batch[i].remove_tag(tag)
+
+    for i, tag in to_add:
+        batch[i].add_tag(tag)
+
+    return batch
 
-    return message
 
-@stage
 def sync_gmail_keywords(message):
-    try:
-        keywords = set(toggle_header(t) for t in message.get_keywords())
-    except AttributeError:
+    keywords = message.get_keywords()
+    if keywords is None:
         return message
 
-    tags = set(str(t) for t in message.get_tags()
-               if t not in exclude_sync_tags)
+    keywords = set(toggle_header(t) for t in keywords)
+
+    # notmuch tags already come back as str; no per-tag str() wrap
+    tags = {t for t in message.get_tags()
+            if t not in exclude_sync_tags}
 
     if not tags ^ keywords:
         return message
@@ -131,48 +163,40 @@ def sync_gmail_keywords(message):
 
     return message
 
-@stage
 def remove_new(message):
     message.remove_tag("new")
     return message
 
-@stage
 def add_mention(message):
-    if '@kotfic' in message.body:
+    if message.body_contains(b'@kotfic'):
         message.add_tag("mention")
     return message
 
-@sink
-def drop(message):
-    pass
-
 
 def log_output():
     if MessageProxy.debug:
         logger.setLevel(logging.INFO)
         # 48 characters for our leading format info
         # Give 60% of screen to message
-        try:
-            _, COLUMNS = subprocess.check_output(['stty', 'size']).split()
-
-            fw = int((int(COLUMNS) - 50)  * 0.15)
-            sw = int((int(COLUMNS) - 50)  * 0.55)
-            ptw = int((int(COLUMNS) - 50) * 0.1)
-            log_format = "{0: <" + str(fw) + "} :: {1: <" + str(sw) + "} :: {2: <" + str(ptw) + "} :: {3}"
-        except Exception:
-            fw, sw, ptw = None, None, None
-            log_format = "{0} :: {1} :: {2} :: {3}"
+        COLUMNS = shutil.get_terminal_size((80, 24)).columns
+
+        fw = int((COLUMNS - 50) * 0.15)
+        sw = int((COLUMNS - 50) * 0.55)
+        ptw = int((COLUMNS - 50) * 0.1)
+        log_format = "{0: <" + str(fw) + "} :: {1: <" + str(sw) + "} :: {2: <" + str(ptw) + "} :: {3}"
     else:
+        fw, sw, ptw = None, None, None
         log_format = ""
 
-    @sink
     def _log_output(message):
         if MessageProxy.debug:
             logger.info(log_format.format(
                 truncate(message.mail['From'], fw),
                 truncate(message.mail['Subject'], sw),
                 str(message._msg.get_tags()),
-                ", ".join(message._add_tags | message._remove_tags)))
+                ", ".join(["+" + t for t in message._add_tags] +
+                          ["-" + t for t in message._remove_tags])))
+        return message
     return _log_output
 
 
@@ -187,16 +211,79 @@ def truncate(s, w):
     return s if len(s) < w else s[:w - 3] + "..."
 
 
-def process_pipeline(query, pipeline):
-    try:
-        for msg in get_messages(query):
-            msg.freeze()
-            pipeline.send(msg)
-            msg.thaw()
+# end_atomic (and its fsync) every this many messages; frequent enough
+# to bound memory, rare enough to amortize the commit
+ATOMIC_CHUNK = 1000
+
+
+def _flush(message):
+    message.flush_tags()
+    MessageProxy.reclaim(message)
+    return message
+
+
+def _worker(args):
+    """Process one shard of message ids with a private DB handle.
+
+    Messages are independent, so the pipeline is an embarrassingly
+    parallel map; each worker opens its own notmuch database (handles
+    must not cross process boundaries) and runs the stages in-line.
+    """
+    stage_factory, batch_stage, message_ids = args
 
+    dbh = db()
+    run = fuse_stages(stage_factory() + [_flush])
+
+    batch = [MessageProxy(msg) for msg in
+             (dbh.find_message(message_id) for message_id in message_ids)
+             if msg is not None]
+
+    if batch_stage is not None:
+        batch = batch_stage(batch)
+
+    for start in range(0, len(batch), ATOMIC_CHUNK):
+        dbh.begin_atomic()
+        try:
+            for message in prefetch(batch[start:start + ATOMIC_CHUNK]):
+                run(message)
+        finally:
+            dbh.end_atomic()
+
+
+def process_pipeline(query, stage_factory, jobs=1, batch_stage=None):
+    try:
+        if jobs > 1:
+            # one cheap scan for ids, then fan the shards out; stages
+            # are rebuilt inside each worker so nothing unpicklable
+            # crosses the fork
+            ids = [m.get_message_id()
+                   for m in Query(db(), query).search_messages()]
+            shards = [ids[i::jobs] for i in range(jobs)]
+
+            with multiprocessing.Pool(jobs) as pool:
+                pool.map(_worker, [(stage_factory, batch_stage, shard)
+                                   for shard in shards if shard])
+            return
+
+        dbh = db()
+        messages = get_messages(dbh, query)
+
+        if batch_stage is not None:
+            messages = batch_stage(messages)
+
+        pipeline = AsyncPipeline(stage_factory() + [_flush])
+
+        # a database-level atomic section per chunk replaces the old
+        # per-message freeze/thaw sub-transactions
+        for start in range(0, len(messages), ATOMIC_CHUNK):
+            dbh.begin_atomic()
+            try:
+                pipeline.process(
+                    prefetch(messages[start:start + ATOMIC_CHUNK]))
+            finally:
+                dbh.end_atomic()
     except notmuch.errors.NullPointerError:
         logger.error("Query returned no results")
-        pipeline.close()
 
 @click.group()
 @click.option('--debug/--no-debug', default=False)
@@ -208,21 +295,30 @@ def main(dryrun, debug):
     if debug:
         logger.setLevel(logging.DEBUG)
 
+def _sync_stages():
+    return [add_mention,
+            remove_new,
+            log_output()]
+
+
+def _sync_keywords_stages():
+    return [sync_gmail_keywords]
+
+
 @main.command()
 @click.argument('query', default='tag:new and path:"**"')
-def sync(query):
+@click.option('--jobs', default=1,
+              help='Shard the query across this many worker processes')
+def sync(query, jobs):
     logger.debug("Query: {}".format(query))
-    process_pipeline(query, Pipeline([sync_gmail_tags,
-                                      add_mention,
-                                      remove_new,
-                                      log_output()]))
+    process_pipeline(query, _sync_stages, jobs=jobs,
+                     batch_stage=sync_gmail_tags_batch)
 
 @main.command()
 @click.argument('query', default='tag:new and path:"**"')
 def sync_keywords(query):
     logger.debug("Query: {}".format(query))
-    process_pipeline(query, Pipeline([sync_gmail_keywords,
-                                      drop]))
+    process_pipeline(query, _sync_keywords_stages)
 
 
 if __name__ == "__main__":
@@ -17,12 +17,42 @@
 # NOTE: Taken from afew.utils
 import notmuch
 import email
+from email.parser import BytesHeaderParser
 import sys
-import codecs
+import asyncio
+import collections
+import mmap
 import re
 import os
 import logging
 import functools
+import queue
+import sqlite3
+import threading
+
+_KW_RE = re.compile(rb'^X-Keywords:[ \t]*([^\r\n]*)', re.MULTILINE)
+_SIGLINE_RE = re.compile(r'^((--)|(__)|(==)|(\*\*)|(##))', re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_keywords(path, mtime_ns):
+    """Memoized X-Keywords parse keyed on (path, mtime), so re-runs of
+    the sync commands over overlapping queries skip the file entirely
+    when nothing changed.  Returns None when the mail has no
+    X-Keywords header at all."""
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ)
+
+    try:
+        m = _KW_RE.search(mm)
+        if m is None:
+            return None
+
+        return tuple(t for t in
+                     bytes(mm[m.start(1):m.end(1)]).decode().strip().split(",")
+                     if t != '')
+    finally:
+        mm.close()
 
 logger = logging.getLogger('email_parser')
 ch = logging.StreamHandler()
@@ -31,84 +61,236 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-class Pipeline(object):
-    """Accepts a list of stages/sink and produces a coroutine pipeline for
-    message processing."""
+def prefetch(messages, n=32):
+    """Readahead wrapper for a message iterable.
 
-    def __init__(self, pipeline):
-        self.pipeline = functools.reduce(
-            lambda a, b: b(a), pipeline[::-1])
+    A background thread stays up to ``n`` messages in front of the
+    consumer, asking the kernel to page in each maildir file
+    (POSIX_FADV_WILLNEED) before parking the message in a bounded
+    queue.  By the time a stage opens the file its pages are already
+    resident, so the serial read-compute-read pattern overlaps disk
+    I/O with processing.
+    """
+    q = queue.Queue(maxsize=n)
+    done = object()
 
-    def send(self, msg):
-        self.pipeline.send(msg)
+    def worker():
+        for msg in messages:
+            try:
+                fd = os.open(msg.get_filename(), os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+            q.put(msg)
+
+        q.put(done)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        msg = q.get()
+        if msg is done:
+            return
+
+        yield msg
+
+
+def fuse_stages(stages):
+    """Compile a stage list into one straight-line run(msg) function.
+
+    The stage list is fixed at command-dispatch time, so instead of a
+    call (or queue hop) per stage per message we exec a specialized
+    body -- msg = f0(msg); msg = f1(msg); ... -- and every message
+    crosses a single Python frame."""
+    names = {'f%d' % i: func for i, func in enumerate(stages)}
+
+    src = ("def run(msg):\n"
+           + "".join("    msg = f%d(msg)\n" % i for i in range(len(stages)))
+           + "    return msg\n")
+
+    exec(src, names)
+    return names['run']
+
+
+class AsyncPipeline(object):
+    """Buffered asyncio pipeline for message processing.  The stages --
+    plain callables taking and returning a message -- are fused into a
+    single straight-line function which a worker task runs in the
+    default executor, fed by a bounded queue.  That way fetching
+    message N+1 from Xapian overlaps processing message N instead of
+    serializing the two I/O streams."""
+
+    _DONE = object()
+
+    def __init__(self, stages, maxsize=64):
+        self.run = fuse_stages(stages)
+        self.maxsize = maxsize
+
+    async def _run(self, messages):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.maxsize)
+
+        async def worker():
+            while True:
+                msg = await queue.get()
+
+                if msg is self._DONE:
+                    break
+
+                await loop.run_in_executor(None, self.run, msg)
+
+        task = loop.create_task(worker())
+
+        # produce from the (blocking) notmuch iterator off-loop
+        it = iter(messages)
+        while True:
+            msg = await loop.run_in_executor(None, next, it, self._DONE)
+
+            # race the put against the worker: if a stage raises, the
+            # worker dies without draining the queue, and a plain
+            # await queue.put() would block forever once it fills --
+            # silently, while the caller holds the DB atomic section
+            put = loop.create_task(queue.put(msg))
+            await asyncio.wait({put, task},
+                               return_when=asyncio.FIRST_COMPLETED)
+
+            if task.done():
+                put.cancel()
+                await task  # re-raise the stage exception, if any
+                return
+
+            if msg is self._DONE:
+                break
+
+        await task
+
+    def process(self, messages):
+        asyncio.run(self._run(messages))
+
+
+class KeywordCache(object):
+    """sqlite-backed (path, mtime_ns) -> synced tag set cache.
+
+    Persists across runs, so a re-sync over an unchanged maildir can
+    skip both the X-Keywords read and the tag diff for any message
+    whose file has not been touched since it was last brought in line.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'),
+                                '.cache', 'email_processor',
+                                'state.sqlite')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(path TEXT PRIMARY KEY, mtime INTEGER, kws TEXT)")
+
+    def get(self, path, mtime_ns):
+        row = self.conn.execute(
+            "SELECT kws FROM cache WHERE path = ? AND mtime = ?",
+            (path, mtime_ns)).fetchone()
+
+        if row is None:
+            return None
+
+        return set(t for t in row[0].split(",") if t != '')
+
+    def put(self, path, mtime_ns, keywords):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+            (path, mtime_ns, ",".join(sorted(keywords))))
+
+    def commit(self):
+        self.conn.commit()
 
 
 class MessageProxy(object):
-    __slots__ = ["_msg", "__weakref__"]
+    __slots__ = ["_msg", "_mmap", "__weakref__"]
 
     dryrun = False
     debug = False
 
+    # free-list of spent proxies; deque append/popleft are atomic so
+    # the executor threads can share it without a lock
+    _pool = collections.deque()
+
+    def __new__(cls, obj):
+        try:
+            return cls._pool.popleft()
+        except IndexError:
+            return object.__new__(cls)
+
+    @classmethod
+    def reclaim(cls, proxy):
+        """Return a proxy to the free-list once its message is done,
+        turning an allocation per message into ~one per pipeline slot.
+        __init__ re-binds the recycled instance to the next message."""
+        proxy._close_map()
+        object.__setattr__(proxy, "_msg", None)
+        cls._pool.append(proxy)
+
     def __init__(self, obj):
         object.__setattr__(self, "_msg", obj)
+        object.__setattr__(self, "_mmap", None)
         self._mail = None
+        self._mail_full = None
         self._body = None
 
         self._add_tags = set([])
         self._remove_tags = set([])
 
-    signature_line_re = re.compile(r'^((--)|(__)|(==)|(\*\*)|(##))')
-
-    def _strip_signatures(self, lines, max_signature_size=10):
+    def _strip_signatures(self, text, max_signature_size=10):
         r'''
         Strip signatures from a mail. Used to filter mails before
         classifying mails.
 
-        :param lines: a mail split at newlines
-        :type  lines: :class:`list` of :class:`str`
+        :param text: the decoded text of a mail part
+        :type  text: :class:`str`
         :param max_signature_size: consider message parts up to this size as signatures
         :type  max_signature_size: int
-        :returns: the mail with signatures stripped off
-        :rtype:   :class:`list` of :class:`str`
-
-
-        >>> strip_signatures([
-        ...     'Huhu',
-        ...     '--',
-        ...     'Ikke',
-        ... ])
-        ['Huhu']
-        >>> strip_signatures([
-        ...     'Huhu',
-        ...     '--',
-        ...     'Ikke',
-        ...     '**',
-        ...     "Sponsored by PowerDoh\'",
-        ...     "Sponsored by PowerDoh\'",
-        ...     "Sponsored by PowerDoh\'",
-        ...     "Sponsored by PowerDoh\'",
-        ...     "Sponsored by PowerDoh\'",
-        ... ], 5)
-        ['Huhu']
+        :returns: the text with signatures stripped off
+        :rtype:   :class:`str`
+
+
+        >>> strip_signatures('Huhu\n--\nIkke')
+        'Huhu'
+        >>> strip_signatures('Huhu\n--\nIkke\n**\n' +
+        ...                  '\n'.join(["Sponsored by PowerDoh'"] * 5), 5)
+        'Huhu'
         '''
 
-        siglines = 0
-        sigline_count = 0
+        matches = list(_SIGLINE_RE.finditer(text))
+        if not matches:
+            return text
 
-        for n, line in enumerate(reversed(lines)):
-            if self.signature_line_re.match(line):
-                # set the last line to include
-                siglines = n + 1
+        total = text.count('\n')
+        cut = None
+        prev = 0
 
-                # reset the line code
-                sigline_count = 0
+        for m in reversed(matches):
+            # lines between this marker and the end of the mail
+            n = total - text.count('\n', 0, m.start())
 
-            if sigline_count >= max_signature_size:
+            # too big a gap since the last marker (or the end of the
+            # mail), everything above is content
+            if n - prev > max_signature_size:
                 break
 
-            sigline_count += 1
+            cut = m.start()
+            prev = n
+
+        if cut is None:
+            return text
 
-        return lines[:-siglines]
+        return text[:max(cut - 1, 0)]
 
     @property
     def body(self):
@@ -123,7 +305,7 @@ class MessageProxy(object):
         '''
         if self._body is None:
             content = []
-            for part in self.mail.walk():
+            for part in self._full_mail.walk():
                 if part.get_content_type() == 'text/plain':
                     raw_payload = part.get_payload(decode=True)
                     encoding = part.get_content_charset()
@@ -138,78 +320,135 @@ class MessageProxy(object):
                         raw_payload = raw_payload.decode(
                             sys.getdefaultencoding(), 'replace')
 
-                    lines = raw_payload.split('\n')
-                    lines = self._strip_signatures(lines)
-
-                    content.append('\n'.join(lines))
+                    content.append(self._strip_signatures(raw_payload))
             self._body = '\n'.join(content)
 
         return self._body
 
     @property
     def mail(self):
+        """Headers-only parse of the mail, enough for From/Subject style
+        lookups without walking (or decoding) the MIME tree."""
         if self._mail is None:
-            if hasattr(email, 'message_from_binary_file'):
-                self._mail = email.message_from_binary_file(
-                    open(self._msg.get_filename(), 'br'))
-            else:
-                if (3, 1) <= sys.version_info < (3, 2):
-                    fp = codecs.open(self._msg.get_filename(),
-                                     'r', 'utf-8', errors='replace')
-                else:
-                    fp = open(self._msg.get_filename())
-
-                    self._mail = email.message_from_file(fp)
+            with open(self._msg.get_filename(), 'rb') as fp:
+                self._mail = BytesHeaderParser().parse(fp)
 
         return self._mail
 
+    @property
+    def _full_mail(self):
+        if self._mail_full is None:
+            with open(self._msg.get_filename(), 'rb') as fp:
+                self._mail_full = email.message_from_binary_file(fp)
+
+        return self._mail_full
+
+    def _map(self):
+        """mmap the maildir file once and cache the mapping, so the
+        kernel can serve the header bytes straight from page cache
+        instead of copying the whole message into a bytes object on
+        every keyword access."""
+        mm = self._mmap
+        if mm is None:
+            with open(self._msg.get_filename(), 'r+b') as fh:
+                mm = mmap.mmap(fh.fileno(), 0)
+            object.__setattr__(self, "_mmap", mm)
+
+        return mm
+
+    def _close_map(self):
+        mm = self._mmap
+        if mm is not None:
+            mm.close()
+            object.__setattr__(self, "_mmap", None)
+
     def _get_keywords(self, s):
-        start = s.find("X-Keywords:")
-        if start == -1:
-            raise AttributeError("X-Keywords header not found")
+        m = _KW_RE.search(s)
+        if m is None:
+            return None
 
-        end = s.find("\n", start)
-        return start + len("X-Keywords:"), end
+        return m.start(1), m.end(1)
 
-    def get_keywords(self):
-        with open(self._msg.get_filename(), 'rb') as fh:
-            m = fh.read()
+    def body_contains(self, needle):
+        """Bytes-level substring test over the mmapped maildir file.
 
-        start, end = self._get_keywords(m)
+        Skips the MIME walk, charset decode and signature strip that
+        .body pays for -- good enough when a predicate on the raw mail
+        is all the caller needs (the search stays in C over page-cache
+        resident bytes).
+        """
+        return self._map().find(needle) != -1
 
-        return [t for t in m[start:end].strip().split(",") if t != '']
+    def get_keywords(self):
+        """Keywords from the X-Keywords header, or None when the mail
+        carries no such header (which callers must not confuse with an
+        empty keyword list)."""
+        path = self._msg.get_filename()
+        keywords = _parse_keywords(path, os.stat(path).st_mtime_ns)
 
-    def set_keywords(self, keywords):
-        with open(self._msg.get_filename(), 'r+b') as fh:
-            m = fh.read()
+        return None if keywords is None else list(keywords)
 
-            start, end = self._get_keywords(m)
-            fh.seek(0)
-            fh.write(m[:start] + ' ' +  b','.join(keywords) + m[end:])
-            fh.truncate()
+    def set_keywords(self, keywords):
+        mm = self._map()
+        span = self._get_keywords(mm)
+        if span is None:
+            return
+
+        start, end = span
+        value = ','.join(keywords).encode()
+
+        if len(value) == end - start:
+            # same-size value: patch the cached mapping in place, no
+            # second read and no rewrite of everything after the header
+            mm[start:end] = value
+            mm.flush()
+        else:
+            # size change shifts the tail; rewrite from the already
+            # resident bytes rather than re-reading the file
+            m = bytes(mm)
+            self._close_map()
+
+            with open(self._msg.get_filename(), 'r+b') as fh:
+                fh.write(m[:start] + value + m[end:])
+                fh.truncate()
 
         self._mail = None
+        self._mail_full = None
+
+    def flush_tags(self):
+        """Flush the tag deltas accumulated by add_tag/remove_tag in
+        one pass.  Callers are expected to have the write batched some
+        other way (message freeze or a database atomic section), so
+        Xapian sees one transaction for many messages rather than one
+        per tag."""
+        self._close_map()
+
+        if not self.dryrun:
+            for tag in self._remove_tags:
+                self._msg.remove_tag(tag, sync_maildir_flags=False)
+
+            for tag in self._add_tags:
+                self._msg.add_tag(tag, sync_maildir_flags=False)
+
+        self._add_tags.clear()
+        self._remove_tags.clear()
+
+    def thaw(self):
+        self.flush_tags()
+        return self._msg.thaw()
 
     def add_tag(self, tag, sync_maildir_flags=False):
         assert tag is not None, "tag is None!"
-        assert tag is not "", "tag is empty!"
+        assert tag != "", "tag is empty!"
 
-        if self.debug:
-            self._add_tags = self._add_tags | (set(["+" + tag]))
-
-        if not self.dryrun:
-            return self._msg.add_tag(
-                tag, sync_maildir_flags=sync_maildir_flags)
+        self._add_tags.add(tag)
+        self._remove_tags.discard(tag)
 
         return notmuch.STATUS.SUCCESS
 
     def remove_tag(self, tag, sync_maildir_flags=False):
-        if self.debug:
-            self._remove_tags =  self._remove_tags | set(["-" + tag])
-
-        if not self.dryrun:
-            return self._msg.remove_tag(
-                tag, sync_maildir_flags=sync_maildir_flags)
+        self._remove_tags.add(tag)
+        self._add_tags.discard(tag)
 
         return notmuch.STATUS.SUCCESS
 
@@ -218,11 +457,12 @@ class MessageProxy(object):
     ###########################################################################
     # Proxying Code
     #
-    def __getattribute__(self, name):
-        try:
-            return object.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(object.__getattribute__(self, "_msg"), name)
+    # __getattr__ is only invoked on a lookup miss, so proxy methods,
+    # properties and slots resolve through the normal C-level path with
+    # no try/except toll on every access; only names we don't define
+    # fall through to the wrapped notmuch message.
+    def __getattr__(self, name):
+        return getattr(object.__getattribute__(self, "_msg"), name)
 
     def __delattr__(self, name):
         delattr(object.__getattribute__(self, "_msg"), name)
@@ -238,58 +478,3 @@ class MessageProxy(object):
 
     def __repr__(self):
         return repr(object.__getattribute__(self, "_msg"))
-
-    #
-    # factories
-    #
-    _special_names = [
-        '__abs__', '__add__', '__and__', '__call__', '__cmp__', '__coerce__',
-        '__contains__', '__delitem__', '__delslice__', '__div__', '__divmod__',
-        '__eq__', '__float__', '__floordiv__', '__ge__', '__getitem__',
-        '__getslice__', '__gt__', '__hash__', '__hex__', '__iadd__', '__iand__',
-        '__idiv__', '__idivmod__', '__ifloordiv__', '__ilshift__', '__imod__',
-        '__imul__', '__int__', '__invert__', '__ior__', '__ipow__', '__irshift__',
-        '__isub__', '__iter__', '__itruediv__', '__ixor__', '__le__', '__len__',
-        '__long__', '__lshift__', '__lt__', '__mod__', '__mul__', '__ne__',
-        '__neg__', '__oct__', '__or__', '__pos__', '__pow__', '__radd__',
-        '__rand__', '__rdiv__', '__rdivmod__', '__reduce__', '__reduce_ex__',
-        '__repr__', '__reversed__', '__rfloorfiv__', '__rlshift__', '__rmod__',
-        '__rmul__', '__ror__', '__rpow__', '__rrshift__', '__rshift__', '__rsub__',
-        '__rtruediv__', '__rxor__', '__setitem__', '__setslice__', '__sub__',
-        '__truediv__', '__xor__', 'next',
-    ]
-
-    @classmethod
-    def _create_class_proxy(cls, theclass):
-        """creates a proxy for the given class"""
-
-        def make_method(name):
-            def method(self, *args, **kw):
-                return getattr(object.__getattribute__(self, "_msg"), name)(*args, **kw)
-            return method
-
-        namespace = {}
-        for name in cls._special_names:
-            if hasattr(theclass, name):
-                namespace[name] = make_method(name)
-        return type("%s(%s)" % (cls.__name__, theclass.__name__), (cls,), namespace)
-
-    def __new__(cls, obj, *args, **kwargs):
-        """
-        creates an proxy instance referencing `obj`. (obj, *args, **kwargs) are
-        passed to this class' __init__, so deriving classes can define an
-        __init__ method of their own.
-        note: _class_proxy_cache is unique per deriving class (each deriving
-        class must hold its own cache)
-        """
-        try:
-            cache = cls.__dict__["_class_proxy_cache"]
-        except KeyError:
-            cls._class_proxy_cache = cache = {}
-        try:
-            theclass = cache[obj.__class__]
-        except KeyError:
-            cache[obj.__class__] = theclass = cls._create_class_proxy(obj.__class__)
-        ins = object.__new__(theclass)
-        theclass.__init__(ins, obj, *args, **kwargs)
-        return ins
@@ -1,5 +1,12 @@
 from setuptools import setup, find_packages
 
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(['email_processor/_sync.pyx'])
+except ImportError:
+    # the pure python fallback in command.py covers us
+    ext_modules = []
+
 setup(name='email_processor',
       version='0.0.0',
       description='Personal email processor',
@@ -9,6 +16,7 @@ setup(name='email_processor',
       url='',
       py_modules=['email_processor'],
       install_requires=[],
+      ext_modules=ext_modules,
       license='Apache 2.0',
       zip_safe=False,
       entry_points= {